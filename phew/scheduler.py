@@ -0,0 +1,186 @@
+import uasyncio, time
+from . import logging
+from .server import loop
+
+_jobs = []
+# the most recently finished (one-shot or cancelled) jobs are kept so
+# that their run times still show up in stats()
+_finished = []
+_finished_size = 8
+_wake = uasyncio.Event()
+_dispatcher_running = False
+
+# once the dispatcher has spent this long running jobs it hands control
+# back to the event loop so that requests are still served promptly, any
+# jobs left over are run (highest priority first) on the next pass
+_slice_ms = 20
+
+
+def _retire(job):
+  if job not in _finished:
+    _finished.append(job)
+    if len(_finished) > _finished_size:
+      _finished.pop(0)
+
+
+def _jitter_ms(jitter_ms):
+  if not jitter_ms:
+    return 0
+  import random
+  return random.randint(0, jitter_ms)
+
+
+class Job:
+  def __init__(self, callback, interval=None, delay=0, budget_ms=None, jitter=0, priority=0, name=None):
+    self.callback = callback
+    self.interval_ms = int(interval * 1000) if interval else None
+    self.budget_ms = budget_ms
+    self.jitter_ms = int(jitter * 1000)
+    self.priority = priority
+    self.name = name if name else getattr(callback, "__name__", "job")
+    # jitter is applied on top of the base time so that it doesn't
+    # accumulate and slow the job down
+    self.base = time.ticks_add(time.ticks_ms(), int(delay * 1000))
+    self.due = time.ticks_add(self.base, _jitter_ms(self.jitter_ms))
+    self.cancelled = False
+    self.running = False
+
+    # run time statistics
+    self.runs = 0
+    self.overruns = 0
+    self.last_ms = 0
+    self.max_ms = 0
+    self.total_ms = 0
+
+  # the decorators return the job in place of the function so calling
+  # it still calls the function
+  def __call__(self, *args, **kwargs):
+    return self.callback(*args, **kwargs)
+
+  def cancel(self):
+    self.cancelled = True
+    if self in _jobs:
+      _jobs.remove(self)
+      # a job cancelling itself is retired by _run once its stats are in
+      if self.runs and not self.running:
+        _retire(self)
+
+  def stats(self):
+    return {
+      "name": self.name,
+      "active": not self.cancelled,
+      "runs": self.runs,
+      "overruns": self.overruns,
+      "last_ms": self.last_ms,
+      "max_ms": self.max_ms,
+      "average_ms": self.total_ms // self.runs if self.runs else 0
+    }
+
+  def __repr__(self):
+    return f"<Job object {self.name} (priority {self.priority})>"
+
+
+async def _run(job):
+  start = time.ticks_ms()
+  job.running = True
+  try:
+    result = job.callback()
+    # coroutine jobs are awaited so their run time includes any awaits
+    if type(result).__name__ in ("generator", "coroutine"):
+      await result
+  except Exception as e:
+    logging.exception(f"> job {job.name} failed: {e}")
+  now = time.ticks_ms()
+  duration = time.ticks_diff(now, start)
+
+  job.running = False
+  job.runs += 1
+  job.last_ms = duration
+  job.max_ms = max(job.max_ms, duration)
+  job.total_ms += duration
+  if job.budget_ms and duration > job.budget_ms:
+    job.overruns += 1
+    logging.warn(f"> job {job.name} overran its budget ({duration}ms > {job.budget_ms}ms)")
+
+  if job.cancelled:
+    # cancelled itself while running
+    _retire(job)
+  elif job.interval_ms:
+    # keep to the original cadence unless we've fallen behind it
+    base = time.ticks_add(job.base, job.interval_ms)
+    if time.ticks_diff(base, now) < 0:
+      base = now
+    job.base = base
+    job.due = time.ticks_add(base, _jitter_ms(job.jitter_ms))
+  else:
+    job.cancel()
+
+
+async def _dispatcher():
+  global _dispatcher_running
+  while _jobs:
+    now = time.ticks_ms()
+    due = [job for job in _jobs if time.ticks_diff(job.due, now) <= 0]
+    due.sort(key=lambda job: job.priority, reverse=True)
+
+    for job in due:
+      if job.cancelled:
+        continue
+      await _run(job)
+      # let pending requests through between every job
+      await uasyncio.sleep_ms(0)
+      if time.ticks_diff(time.ticks_ms(), now) > _slice_ms:
+        break
+
+    if not _jobs:
+      break
+
+    # sleep until the next job is due or a new job is scheduled
+    now = time.ticks_ms()
+    delay = min(time.ticks_diff(job.due, now) for job in _jobs)
+    if delay > 0:
+      try:
+        await uasyncio.wait_for_ms(_wake.wait(), delay)
+      except uasyncio.TimeoutError:
+        pass
+      _wake.clear()
+  _dispatcher_running = False
+
+
+# adds a job to the scheduler, interval is the number of seconds between
+# runs for periodic jobs or None for a one-shot job
+def schedule(callback, interval=None, delay=0, budget_ms=None, jitter=0, priority=0, name=None):
+  global _dispatcher_running
+  job = Job(callback, interval, delay, budget_ms, jitter, priority, name)
+  _jobs.append(job)
+  if _dispatcher_running:
+    _wake.set()
+  else:
+    _dispatcher_running = True
+    loop.create_task(_dispatcher())
+  return job
+
+
+def cancel(job):
+  job.cancel()
+
+
+# decorator shorthand for adding a periodic job, the decorated name is
+# bound to the Job so that it can be cancelled later
+def every(interval, delay=0, budget_ms=None, jitter=0, priority=0, name=None):
+  def _every(f):
+    return schedule(f, interval, delay, budget_ms, jitter, priority, name)
+  return _every
+
+
+# decorator shorthand for adding a one-shot job
+def once(delay=0, budget_ms=None, jitter=0, priority=0, name=None):
+  def _once(f):
+    return schedule(f, None, delay, budget_ms, jitter, priority, name)
+  return _once
+
+
+# returns run time statistics for every scheduled job along with the
+# most recently finished ones
+def stats():
+  return [job.stats() for job in _jobs + _finished]
@@ -5,6 +5,17 @@ _routes = []
 catchall_handler = None
 loop = uasyncio.get_event_loop()
 
+# content types that will be compressed on the fly if the client accepts
+# it, compression is disabled until enable_compression() is called
+_compress_types = None
+_compress_min_size = 512
+_compress_window_bits = 10
+
+# token buckets for rate limited routes keyed by client ip and route path,
+# kept in least recently used order so idle clients are evicted first
+_rate_limit_buckets = None
+_rate_limit_table_size = 32
+
 
 def file_exists(filename):
   try:
@@ -64,7 +75,7 @@ data: {self.data}"""
 class Response:
   def __init__(self, body, status=200, headers={}):
     self.status = status
-    self.headers = headers
+    self.headers = dict(headers)
     self.body = body
 
   def add_header(self, name, value):
@@ -93,7 +104,7 @@ content_type_map = {
 class FileResponse(Response):
   def __init__(self, file, status=200, headers={}):
     self.status = 404
-    self.headers = headers
+    self.headers = dict(headers)
     self.file = file
 
     try:
@@ -103,18 +114,240 @@ class FileResponse(Response):
         # auto set content type
         extension = self.file.split(".")[-1].lower()
         if extension in content_type_map:
-          headers["Content-Type"] = content_type_map[extension]
+          self.headers["Content-Type"] = content_type_map[extension]
 
-        headers["Content-Length"] = os.stat(self.file)[6]
+        self.headers["Content-Length"] = os.stat(self.file)[6]
     except OSError:
       return False
 
 
+# iterators (generators, map, filter, iter(list)...) return themselves from
+# iter(), this works on micropython where they don't expose __next__
+def _is_iterator(value):
+  try:
+    return iter(value) is value
+  except TypeError:
+    return False
+
+
+# yields a json encoding of value in small pieces, dicts, lists, tuples
+# and iterators (including generators) are walked rather than encoded in
+# one go so the full document never needs to be held in memory. bytes are
+# decoded as utf-8 and written out as strings
+def _json_pieces(value):
+  import json
+  if isinstance(value, dict):
+    yield "{"
+    first = True
+    for key, item in value.items():
+      if not first:
+        yield ","
+      first = False
+      yield json.dumps(str(key))
+      yield ":"
+      yield from _json_pieces(item)
+    yield "}"
+  elif isinstance(value, (bytes, bytearray)):
+    yield json.dumps(value.decode("utf-8"))
+  elif isinstance(value, (list, tuple)) or _is_iterator(value):
+    yield "["
+    first = True
+    for item in value:
+      if not first:
+        yield ","
+      first = False
+      yield from _json_pieces(item)
+    yield "]"
+  else:
+    # anything else is encoded as is so unsupported types fail just as
+    # they would with json.dumps
+    yield json.dumps(value)
+
+
+# gathers the json pieces into chunks of roughly chunk_size bytes
+def _json_chunks(value, chunk_size):
+  pieces = []
+  size = 0
+  for piece in _json_pieces(value):
+    pieces.append(piece)
+    size += len(piece)
+    if size >= chunk_size:
+      yield "".join(pieces).encode("utf-8")
+      pieces = []
+      size = 0
+  if pieces:
+    yield "".join(pieces).encode("utf-8")
+
+
+class JSONResponse(Response):
+  def __init__(self, data, status=200, headers={}, chunk_size=256):
+    self.status = status
+    self.headers = dict(headers)
+    if "Content-Type" not in self.headers:
+      self.headers["Content-Type"] = "application/json"
+    self.body = _json_chunks(data, chunk_size)
+
+
+# a channel that any number of clients can subscribe to for server-sent
+# events. each event is encoded once into a shared buffer which is then
+# queued for every subscriber rather than being rendered per client
+class EventChannel:
+  def __init__(self, history=8, heartbeat=15, max_pending=2048):
+    self.heartbeat = heartbeat
+    self.max_pending = max_pending
+    self._subscribers = []
+    # ring buffer of recent (id, buffer) pairs for Last-Event-ID replay
+    self._history = [None] * history
+    self._history_caret = 0
+    self._last_id = 0
+
+  def publish(self, data, event=None):
+    self._last_id += 1
+    lines = [f"id: {self._last_id}"]
+    if event:
+      lines.append(f"event: {event}")
+    for line in str(data).split("\n"):
+      lines.append(f"data: {line}")
+    buffer = ("\n".join(lines) + "\n\n").encode("utf-8")
+
+    if self._history:
+      self._history[self._history_caret] = (self._last_id, buffer)
+      self._history_caret = (self._history_caret + 1) % len(self._history)
+
+    # iterate a copy as slow subscribers may be dropped while we send
+    for subscriber in self._subscribers[:]:
+      subscriber.send(buffer)
+
+  # returns a response that, when returned from a route handler, keeps
+  # the connection open and streams events to the client
+  def subscribe(self, request):
+    return EventStream(self, request.headers.get("last-event-id", None))
+
+  def subscriber_count(self):
+    return len(self._subscribers)
+
+  # returns the events in the history newer than the supplied id, oldest
+  # first. if they won't all fit in max_pending then only the newest that
+  # do are returned so a reconnecting client is never dropped by replay
+  def _replay(self, last_event_id):
+    buffers = []
+    size = 0
+    count = len(self._history)
+    for i in range(1, count + 1):
+      entry = self._history[(self._history_caret - i) % count]
+      if not entry or entry[0] <= last_event_id:
+        break
+      if size + len(entry[1]) > self.max_pending:
+        break
+      buffers.insert(0, entry[1])
+      size += len(entry[1])
+    return buffers
+
+  async def _serve(self, writer, last_event_id):
+    subscriber = _EventSubscriber(self, writer, uasyncio.current_task())
+    if last_event_id:
+      try:
+        for buffer in self._replay(int(last_event_id)):
+          subscriber.send(buffer)
+      except ValueError:
+        pass
+    self._subscribers.append(subscriber)
+
+    try:
+      while not subscriber.dropped:
+        if not subscriber.pending:
+          try:
+            await uasyncio.wait_for(subscriber.ready.wait(), self.heartbeat)
+          except uasyncio.TimeoutError:
+            # comment line keeps the connection (and any proxies) alive
+            await subscriber.write(b":\n\n")
+          subscriber.ready.clear()
+
+        while subscriber.pending and not subscriber.dropped:
+          buffer = subscriber.pending.pop(0)
+          subscriber.pending_size -= len(buffer)
+          await subscriber.write(buffer)
+    except (OSError, uasyncio.TimeoutError):
+      # client went away or stopped reading
+      pass
+    except uasyncio.CancelledError:
+      # woken from a stalled write because the subscriber was dropped,
+      # anything else cancelling us should still be passed on
+      if not subscriber.dropped:
+        raise
+    finally:
+      subscriber.drop()
+    # the socket itself is closed by _handle_request once we return
+
+
+class _EventSubscriber:
+  def __init__(self, channel, writer, task):
+    self.channel = channel
+    self.writer = writer
+    self.task = task
+    self.pending = []
+    self.pending_size = 0
+    self.dropped = False
+    self.writing = False
+    self.ready = uasyncio.Event()
+
+  # queue a shared buffer for sending. only a client that is stuck part
+  # way through a write counts as slow, a burst published before the
+  # serving task has had a chance to run is queued in full
+  def send(self, buffer):
+    self.pending.append(buffer)
+    self.pending_size += len(buffer)
+    if self.writing and self.pending_size > self.channel.max_pending:
+      logging.debug("> dropping slow event stream subscriber")
+      self.drop()
+      return
+    self.ready.set()
+
+  # a client that stops reading would otherwise leave us waiting on
+  # drain() forever, so give up if it takes longer than a heartbeat
+  async def write(self, buffer):
+    self.writer.write(buffer)
+    self.writing = True
+    try:
+      await uasyncio.wait_for(self.writer.drain(), self.channel.heartbeat)
+    finally:
+      self.writing = False
+
+  # stream.close() does nothing on micropython so rather than closing the
+  # connection here the serving task is woken (cancelling any stalled
+  # write) and left to return, _handle_request then closes the socket
+  def drop(self):
+    if self.dropped:
+      return
+    self.dropped = True
+    self.pending = []
+    self.pending_size = 0
+    if self in self.channel._subscribers:
+      self.channel._subscribers.remove(self)
+    if self.writing:
+      self.task.cancel()
+    self.ready.set()
+
+
+class EventStream(Response):
+  def __init__(self, channel, last_event_id=None):
+    self.status = 200
+    self.headers = {
+      "Content-Type": "text/event-stream",
+      "Cache-Control": "no-cache"
+    }
+    self.body = None
+    self.channel = channel
+    self.last_event_id = last_event_id
+
+
 class Route:
-  def __init__(self, path, handler, methods=["GET"]):
+  def __init__(self, path, handler, methods=["GET"], compress=None, rate_limit=None):
     self.path = path
     self.methods = methods
     self.handler = handler
+    self.compress = compress
+    self.rate_limit = rate_limit
     self.path_parts = path.split("/")
 
   # returns True if the supplied request matches this route
@@ -170,6 +403,43 @@ def _match_route(request):
   return None
 
 
+# takes a token from the client's bucket for this route, returns 0 if the
+# request can go ahead or the number of seconds until it could be retried
+def _take_rate_limit_token(route, client):
+  global _rate_limit_buckets
+  if _rate_limit_buckets is None:
+    from collections import OrderedDict
+    _rate_limit_buckets = OrderedDict()
+
+  requests, seconds = route.rate_limit
+  key = (client, route.path)
+  now = time.ticks_ms()
+
+  bucket = _rate_limit_buckets.pop(key, None)
+  if bucket is None:
+    # table full, evict the least recently seen client
+    if len(_rate_limit_buckets) >= _rate_limit_table_size:
+      _rate_limit_buckets.pop(next(iter(_rate_limit_buckets)))
+    bucket = [requests, now]
+  else:
+    elapsed = time.ticks_diff(now, bucket[1])
+    if elapsed < 0:
+      # idle for so long that the tick counter wrapped, it's certainly full
+      bucket[0] = requests
+    else:
+      bucket[0] = min(requests, bucket[0] + elapsed * requests / (seconds * 1000))
+    bucket[1] = now
+  # reinserting moves the bucket to the most recently used end
+  _rate_limit_buckets[key] = bucket
+
+  if bucket[0] >= 1:
+    bucket[0] -= 1
+    return 0
+  # round up to whole seconds for the Retry-After header
+  wait = (1 - bucket[0]) * seconds / requests
+  return int(wait) if wait == int(wait) else int(wait) + 1
+
+
 # if the content type is multipart/form-data then parse the fields
 async def _parse_form_data(reader, headers):
   boundary = headers["content-type"].split("boundary=")[1]
@@ -200,12 +470,219 @@ async def _parse_form_data(reader, headers):
   return None
 
 
+# bytes that end a json number or literal
+_json_delimiters = (0x20, 0x09, 0x0a, 0x0d, 0x2c, 0x3a, 0x5d, 0x7d)
+_json_literals = {b"true": True, b"false": False, b"null": None}
+
+
+# incremental json parser, data is fed in as it arrives and the document
+# is built up without ever holding the whole body in one buffer. like the
+# rest of the server it assumes the input is well formed
+class _JSONParser:
+  def __init__(self):
+    self._stack = [] # containers that are still open
+    self._keys = [] # pending key for each open container
+    self._token = None # raw bytes of the string or scalar being read
+    self._string = False
+    self._escape = False
+    self.value = None
+
+  def _emit(self, value):
+    if not self._stack:
+      self.value = value
+      return
+    container = self._stack[-1]
+    if isinstance(container, list):
+      container.append(value)
+    elif self._keys[-1] is None:
+      self._keys[-1] = value
+    else:
+      container[self._keys[-1]] = value
+      self._keys[-1] = None
+
+  def _end_token(self):
+    token = self._token
+    self._token = None
+    if token[0] == 0x22: # string
+      if b"\\" in token:
+        import json
+        self._emit(json.loads(token.decode("utf-8")))
+      else:
+        self._emit(token[1:-1].decode("utf-8"))
+    elif token in _json_literals:
+      self._emit(_json_literals[token])
+    else:
+      try:
+        self._emit(int(token.decode()))
+      except ValueError:
+        self._emit(float(token.decode()))
+
+  def feed(self, data):
+    i = 0
+    length = len(data)
+    while i < length:
+      start = i
+      if self._string:
+        # consume up to and including the closing quote
+        while i < length:
+          c = data[i]
+          i += 1
+          if self._escape:
+            self._escape = False
+          elif c == 0x5c:
+            self._escape = True
+          elif c == 0x22:
+            self._string = False
+            break
+        self._token += data[start:i]
+        if not self._string:
+          self._end_token()
+        continue
+
+      if self._token is not None:
+        # numbers and literals run until the next delimiter
+        while i < length and data[i] not in _json_delimiters:
+          i += 1
+        self._token += data[start:i]
+        if i < length:
+          self._end_token()
+        continue
+
+      c = data[i]
+      i += 1
+      if c == 0x22:
+        self._string = True
+        self._token = b'"'
+      elif c == 0x7b or c == 0x5b: # { or [
+        self._stack.append({} if c == 0x7b else [])
+        self._keys.append(None)
+      elif c == 0x7d or c == 0x5d: # } or ]
+        self._keys.pop()
+        self._emit(self._stack.pop())
+      elif c not in _json_delimiters:
+        self._token = data[start:i]
+
+  def close(self):
+    if self._token is not None:
+      self._end_token()
+    return self.value
+
+
 # if the content type is application/json then parse the body
 async def _parse_json_body(reader, headers):
-  import json
-  content_length_bytes = int(headers["content-length"])
-  body = await reader.readexactly(content_length_bytes)
-  return json.loads(body.decode())
+  parser = _JSONParser()
+  content_length = int(headers["content-length"])
+  while content_length > 0:
+    data = await reader.read(min(content_length, 512))
+    if len(data) == 0:
+      break
+    content_length -= len(data)
+    parser.feed(data)
+  return parser.close()
+
+
+# streaming deflate/gzip compressor, uses the deflate module on
+# micropython and falls back to zlib elsewhere
+class _Compressor:
+  def __init__(self, encoding, window_bits):
+    self._zlib = None
+    try:
+      import deflate, io
+      self._sink = io.BytesIO()
+      format = deflate.GZIP if encoding == "gzip" else deflate.ZLIB
+      self._stream = deflate.DeflateIO(self._sink, format, window_bits)
+    except ImportError:
+      import zlib
+      if encoding == "gzip":
+        window_bits += 16
+      self._zlib = zlib.compressobj(6, zlib.DEFLATED, window_bits)
+
+  # returns whatever compressed output is ready, reusing the sink
+  # buffer so memory use stays bounded
+  def _take(self):
+    size = self._sink.tell()
+    if size == 0:
+      return b""
+    data = self._sink.getvalue()[:size]
+    self._sink.seek(0)
+    return data
+
+  def compress(self, chunk):
+    if isinstance(chunk, str):
+      chunk = chunk.encode("utf-8")
+    if self._zlib:
+      return self._zlib.compress(chunk)
+    self._stream.write(chunk)
+    return self._take()
+
+  def finish(self):
+    if self._zlib:
+      return self._zlib.flush()
+    self._stream.close()
+    return self._take()
+
+
+# wraps a response body in a generator that yields compressed chunks
+def _compress_body(body, compressor):
+  if type(body).__name__ != "generator":
+    body = (body,)
+  for chunk in body:
+    data = compressor.compress(chunk)
+    if data:
+      yield data
+  yield compressor.finish()
+
+
+# returns the content encoding to use for this response or None
+def _compression_encoding(request, route, response):
+  if isinstance(response, (FileResponse, EventStream)):
+    return None
+  if "Content-Encoding" in response.headers:
+    return None
+  if hasattr(response.body, "__len__") and len(response.body) == 0:
+    return None
+
+  compress = route.compress if route else None
+  if compress is False:
+    return None
+  if compress is None:
+    if not _compress_types:
+      return None
+    content_type = response.headers.get("Content-Type", "").split(";")[0]
+    if content_type not in _compress_types:
+      return None
+    if hasattr(response.body, "__len__") and len(response.body) < _compress_min_size:
+      return None
+
+  # pick the supported encoding with the highest q-value, q=0 means the
+  # client refuses it
+  accepted = _parse_accept_encoding(request.headers.get("accept-encoding", ""))
+  best, best_q = None, 0
+  for encoding in ("gzip", "deflate"):
+    q = accepted.get(encoding, accepted.get("*", 0))
+    if q > best_q:
+      best, best_q = encoding, q
+  return best
+
+
+# returns a dict of encoding name to q-value from an Accept-Encoding header
+def _parse_accept_encoding(header):
+  result = {}
+  for item in header.split(","):
+    parts = item.split(";")
+    name = parts[0].strip().lower()
+    if not name:
+      continue
+    q = 1
+    for parameter in parts[1:]:
+      parameter = parameter.strip()
+      if parameter.startswith("q="):
+        try:
+          q = float(parameter[2:])
+        except ValueError:
+          q = 0
+    result[name] = q
+  return result
 
 
 status_message_map = {
@@ -220,25 +697,14 @@ status_message_map = {
   408: "Request Timeout", 409: "Conflict", 410: "Gone",
   414: "URI Too Long", 415: "Unsupported Media Type", 
   416: "Range Not Satisfiable", 418: "I'm a teapot",
+  429: "Too Many Requests",
   500: "Internal Server Error", 501: "Not Implemented"
 }
 
 
-# handle an incoming request to the web server
-async def _handle_request(reader, writer):
-  response = None
-
-  request_start_time = time.ticks_ms()
-
-  request_line = await reader.readline()
-  try:
-    method, uri, protocol = request_line.decode().split()
-  except Exception as e:
-    logging.error(e)
-    return
-
-  request = Request(method, uri, protocol)
-  request.headers = await _parse_headers(reader)
+# parses the request body into the form or data members if it's in
+# one of the formats that we understand
+async def _parse_body(reader, request):
   if "content-length" in request.headers and "content-type" in request.headers:
     if request.headers["content-type"].startswith("multipart/form-data"):
       request.form = await _parse_form_data(reader, request.headers)
@@ -255,18 +721,50 @@ async def _handle_request(reader, writer):
         form_data += data
       request.form = _parse_query_string(form_data.decode()) 
 
+
+# handle an incoming request to the web server
+async def _handle_request(reader, writer):
+  response = None
+
+  request_start_time = time.ticks_ms()
+
+  request_line = await reader.readline()
+  try:
+    method, uri, protocol = request_line.decode().split()
+  except Exception as e:
+    logging.error(e)
+    return
+
+  request = Request(method, uri, protocol)
+  request.headers = await _parse_headers(reader)
+
   route = _match_route(request)
-  if route:
-    response = route.call_handler(request)
-  elif catchall_handler:
-    response = catchall_handler(request)
+
+  # check rate limits before spending any effort on the request body
+  retry_after = 0
+  if route and route.rate_limit:
+    client = writer.get_extra_info("peername")[0]
+    retry_after = _take_rate_limit_token(route, client)
+
+  if retry_after:
+    response = Response("", 429, {"Retry-After": retry_after, "Content-Length": 0})
+  else:
+    await _parse_body(reader, request)
+    if route:
+      response = route.call_handler(request)
+    elif catchall_handler:
+      response = catchall_handler(request)
+
+  # if the handler handed its work to the worker then wait for the result
+  if type(response).__name__ == "WorkerJob":
+    response = await response.wait()
 
   # if shorthand body generator only notation used then convert to tuple
   if type(response).__name__ == "generator":
     response = (response,)
 
   # if shorthand body text only notation used then convert to tuple
-  if isinstance(response, str):
+  if isinstance(response, (str, bytes)):
     response = (response,)
 
   # if shorthand tuple notation used then build full response object
@@ -278,6 +776,21 @@ async def _handle_request(reader, writer):
     response.add_header("Content-Type", content_type)
     if hasattr(body, '__len__'):
       response.add_header("Content-Length", len(body))
+
+  encoding = _compression_encoding(request, route, response)
+  if encoding:
+    # create the compressor before any headers are written so that we can
+    # still fall back to an uncompressed response if it isn't supported
+    try:
+      compressor = _Compressor(encoding, _compress_window_bits)
+    except Exception as e:
+      logging.warn(f"> unable to compress response: {e}")
+      encoding = None
+  if encoding:
+    response.body = _compress_body(response.body, compressor)
+    response.headers.pop("Content-Length", None)
+    response.add_header("Content-Encoding", encoding)
+    response.add_header("Vary", "Accept-Encoding")
   
   # write status line
   status_message = status_message_map.get(response.status, "Unknown")
@@ -299,6 +812,9 @@ async def _handle_request(reader, writer):
           break
         writer.write(chunk)
         await writer.drain()
+  elif isinstance(response, EventStream):
+    # server-sent events, hold the connection open until the client leaves
+    await response.channel._serve(writer, response.last_event_id)
   elif type(response.body).__name__ == "generator":
     # generator
     for chunk in response.body:
@@ -317,9 +833,9 @@ async def _handle_request(reader, writer):
 
 
 # adds a new route to the routing table
-def add_route(path, handler, methods=["GET"]):
+def add_route(path, handler, methods=["GET"], compress=None, rate_limit=None):
   global _routes
-  _routes.append(Route(path, handler, methods))
+  _routes.append(Route(path, handler, methods, compress, rate_limit))
   # descending complexity order so most complex routes matched first
   _routes = sorted(_routes, key=lambda route: len(route.path_parts), reverse=True)
 
@@ -330,9 +846,9 @@ def set_callback(handler):
 
 
 # decorator shorthand for adding a route
-def route(path, methods=["GET"]):
+def route(path, methods=["GET"], compress=None, rate_limit=None):
   def _route(f):
-    add_route(path, f, methods=methods)
+    add_route(path, f, methods=methods, compress=compress, rate_limit=rate_limit)
     return f
   return _route
 
@@ -345,6 +861,29 @@ def catchall():
   return _catchall
   
 
+# turns on compression of dynamic responses for clients that accept it
+def enable_compression(content_types=["text/html", "text/css", "text/javascript", "application/json"], min_size=512, window_bits=10):
+  global _compress_types, _compress_min_size, _compress_window_bits
+  # make sure this firmware can actually compress before turning it on
+  try:
+    compressor = _Compressor("gzip", window_bits)
+    compressor.compress(b"phew")
+    compressor.finish()
+  except Exception as e:
+    logging.warn(f"> compression not supported, leaving it disabled: {e}")
+    _compress_types = None
+    return False
+  _compress_types = content_types
+  _compress_min_size = min_size
+  _compress_window_bits = window_bits
+  return True
+
+
+def disable_compression():
+  global _compress_types
+  _compress_types = None
+
+
 def redirect(url, status = 301):
   return Response("", status, {"Location": url})
 
@@ -0,0 +1,127 @@
+import uasyncio
+from . import logging
+
+try:
+  import _thread
+except ImportError:
+  _thread = None
+
+_queue = []
+_lock = None
+# held while the queue is empty, idle workers block trying to acquire it
+_signal = None
+_workers = None
+
+# rendered templates are handed back in pieces of roughly this many bytes
+_piece_size = 512
+
+
+# handle for a job that has been handed to the worker, await wait() to
+# get the result (or have the exception raised by the job re-raised)
+class WorkerJob:
+  def __init__(self, function, args, kwargs):
+    self.function = function
+    self.args = args
+    self.kwargs = kwargs
+    self.done = False
+    self.value = None
+    self.error = None
+    self._flag = uasyncio.ThreadSafeFlag()
+
+  def _run(self):
+    try:
+      self.value = self.function(*self.args, **self.kwargs)
+    except Exception as e:
+      self.error = e
+    self.function = self.args = self.kwargs = None
+    # set last so the event loop never sees a half finished result
+    self.done = True
+    self._flag.set()
+
+  async def wait(self):
+    while not self.done:
+      await self._flag.wait()
+    if self.error:
+      raise self.error
+    return self.value
+
+  def __repr__(self):
+    return f"<WorkerJob object ({'done' if self.done else 'pending'})>"
+
+
+def _worker():
+  while True:
+    _signal.acquire()
+    with _lock:
+      job = _queue.pop(0) if _queue else None
+      # more work waiting so let the next acquire (ours or another
+      # worker's) straight through
+      if _queue and _signal.locked():
+        _signal.release()
+    if job:
+      job._run()
+
+
+# starts the worker threads, on the pico there is only one spare core so
+# only one worker can be started. returns the number of running workers
+def start(workers=1):
+  global _lock, _signal, _workers
+  if _workers is None:
+    _workers = 0
+  if not _thread:
+    return _workers
+  if _lock is None:
+    _lock = _thread.allocate_lock()
+    _signal = _thread.allocate_lock()
+    _signal.acquire()
+  while _workers < workers:
+    try:
+      _thread.start_new_thread(_worker, ())
+    except (OSError, RuntimeError) as e:
+      logging.warn(f"> unable to start worker thread: {e}")
+      break
+    _workers += 1
+  return _workers
+
+
+# queues function to be called with the supplied arguments on a worker
+# thread, if no worker is available then it is called immediately instead
+def run(function, *args, **kwargs):
+  job = WorkerJob(function, args, kwargs)
+  if _workers is None:
+    start()
+  if _workers:
+    with _lock:
+      _queue.append(job)
+      if _signal.locked():
+        _signal.release()
+  else:
+    job._run()
+  return job
+
+
+# yields the rendered pieces, releasing each one as it's sent
+def _send_pieces(pieces):
+  for i in range(len(pieces)):
+    piece = pieces[i]
+    pieces[i] = None
+    yield piece
+
+
+# renders a template on the worker thread. the whole page is held in
+# memory, but as a list of small pieces rather than one large buffer, and
+# the job result is a generator over them that can be used as a body
+def render_template(template, **kwargs):
+  from .template import render_template as _render_template
+  def _render():
+    pieces = []
+    piece = b""
+    for chunk in _render_template(template, **kwargs):
+      piece += chunk if isinstance(chunk, bytes) else str(chunk).encode("utf-8")
+      if len(piece) >= _piece_size:
+        pieces.append(piece)
+        piece = b""
+    if piece:
+      pieces.append(piece)
+    return _send_pieces(pieces)
+  return run(_render)